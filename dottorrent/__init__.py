@@ -23,12 +23,15 @@
 
 from base64 import b32encode
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from hashlib import sha1, md5
 import fnmatch
-import math
 import os
+import queue
+import re
 import sys
+import threading
 from urllib.parse import urlparse
 
 from bencoder import bencode
@@ -38,36 +41,283 @@ from . import exceptions
 
 DEFAULT_CREATOR = "dottorrent/{} (https://github.com/kz26/dottorrent)".format(
     __version__)
+_DEFAULT_CREATOR_B = DEFAULT_CREATOR.encode()
+_SEP_B = os.sep.encode()
 
 
 MIN_PIECE_SIZE = 2 ** 14
 MAX_PIECE_SIZE = 2 ** 26
-
-
-if sys.version_info >= (3, 5) and os.name == 'nt':
+# upper bound on memory used for piece buffers in generate()
+PIECE_BUFFER_MEMORY = 2 ** 28
+# minimum amount of piece data hashed per job in generate()
+HASH_BATCH_SIZE = 2 ** 20
+# how much of the upcoming files generate() asks the OS to prefetch
+READAHEAD_SIZE = 2 ** 23
+
+# Plain scheme://netloc URLs that urlparse() gives both parts for on every
+# Python version. The netloc may not contain whitespace, control
+# characters, brackets or non-ASCII characters, which urlparse() strips,
+# validates or rejects depending on the version; those URLs are left to
+# urlparse() itself.
+_URL_RE = re.compile(
+    r'[a-zA-Z][a-zA-Z0-9+.-]*://[^/?#\[\]\x00-\x20\x7f-\U0010ffff]+'
+    r'(?:[/?#]|\Z)')
+
+
+if os.name == 'nt':
     import stat
 
     def is_hidden_file(path):
-        fn = path.split(os.sep)[-1]
+        fn = path.rpartition(os.sep)[2]
         return fn.startswith('.') or \
             bool(os.stat(path).st_file_attributes &
                  stat.FILE_ATTRIBUTE_HIDDEN)
 else:
     def is_hidden_file(path):
-        fn = path.split(os.sep)[-1]
+        fn = path.rpartition(os.sep)[2]
         return fn.startswith('.')
 
 
+def _auto_piece_size(total_size):
+    # smallest power of 2 that gives at most 1500 pieces, within limits
+    ps = 1 << (-(-total_size // 1500) - 1).bit_length()
+    return min(max(ps, MIN_PIECE_SIZE), MAX_PIECE_SIZE)
+
+
 def print_err(v):
     print(v, file=sys.stderr)
 
 
+def _validate_urls(value):
+    urls = []
+    if value:
+        for u in value:
+            if not (isinstance(u, str) and _URL_RE.match(u)):
+                pr = urlparse(u)
+                if not (pr.scheme and pr.netloc):
+                    raise exceptions.InvalidURLException(u)
+            urls.append(u)
+    return urls
+
+
+# hashlib only provides SHA-NI/AVX2 accelerated SHA-1 when it is built
+# against OpenSSL; otherwise prefer OpenSSL through cryptography if present.
+# Setting DOTTORRENT_FORCE_HASHLIB in the environment always uses hashlib.
+try:
+    from _hashlib import openssl_sha1 as _openssl_sha1
+except ImportError:
+    _openssl_sha1 = None
+
+_crypto_hashes = None
+if _openssl_sha1 is None and not os.environ.get('DOTTORRENT_FORCE_HASHLIB'):
+    try:
+        from cryptography.hazmat.primitives import hashes as _crypto_hashes
+    except ImportError:
+        pass
+
+
+class _CryptographySHA1(object):
+    """
+    Minimal hashlib-style wrapper around cryptography's SHA-1.
+    """
+
+    def __init__(self, data=None, _ctx=None):
+        if _ctx is None:
+            _ctx = _crypto_hashes.Hash(_crypto_hashes.SHA1())
+        self._ctx = _ctx
+        if data is not None:
+            self.update(data)
+
+    def update(self, data):
+        self._ctx.update(data)
+
+    def copy(self):
+        return _CryptographySHA1(_ctx=self._ctx.copy())
+
+    def digest(self):
+        return self._ctx.copy().finalize()
+
+
+# SHA-1 constructor used for piece hashing
+HASHER = sha1 if _crypto_hashes is None else _CryptographySHA1
+
+
+def _sha1_pieces(data, piece_size, proto):
+    # copying a fresh hash object is slightly cheaper than constructing one
+    digests = []
+    for i in range(0, len(data), piece_size):
+        h = proto.copy()
+        h.update(data[i:i + piece_size])
+        digests.append(h.digest())
+    return b''.join(digests)
+
+
+def _prefetch(path, length):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, length, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+
+def _md5_file(path, stop):
+    # returns None if stop is set before the whole file is read
+    md5_hasher = md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b''):
+            if stop.is_set():
+                return None
+            md5_hasher.update(chunk)
+    return md5_hasher.hexdigest()
+
+
+class _PieceReader(object):
+    """
+    Reads files into piece buffers on a background thread and submits each
+    full buffer to a pool of hashing threads (hashlib releases the GIL), so
+    disk reads overlap with hashing. Buffers are recycled through the free
+    queue, which also bounds the number of pieces in flight. If an
+    md5_executor is given, each file is read again there for its MD5 hash.
+    """
+
+    def __init__(self, files, piece_size, batch_size, num_buffers, executor,
+                 md5_inline=False, md5_executor=None):
+        self.files = files
+        self.piece_size = piece_size
+        self.executor = executor
+        self.md5_inline = md5_inline
+        self.md5_executor = md5_executor
+        self.md5_futures = []
+        self.error = None
+        self._proto = HASHER()
+        self._views = [memoryview(bytearray(batch_size))
+                       for _ in range(num_buffers)]
+        self._free = queue.Queue()
+        for k in range(num_buffers):
+            self._free.put(k)
+        self._done = queue.Queue()
+        self._stop = threading.Event()
+        self._finished = False
+        # files[self._ahead:] have not been prefetched yet
+        self._ahead = 0
+        self._ahead_bytes = 0
+        self._thread = threading.Thread(target=self._run)
+
+    def start(self):
+        self._thread.start()
+
+    def results(self):
+        """
+        Yields ``(filenames, digests)`` for each batch in order, where
+        filenames holds the file each piece of the batch ends in.
+        """
+        while True:
+            item = self._done.get()
+            if item is None:
+                self._finished = True
+                return
+            fns, future, k = item
+            digests = future.result()
+            self._free.put(k)
+            yield fns, digests
+
+    def close(self):
+        if not self._finished:
+            # stopped early, wake up the reader and let it finish
+            self._stop.set()
+            self._free.put(None)
+            while self._done.get() is not None:
+                pass
+        self._thread.join()
+        if not self._finished or self.error is not None:
+            # don't wait on MD5 hashes that will never be used
+            self._stop.set()
+            for fe, future in self.md5_futures:
+                future.cancel()
+
+    def _run(self):
+        try:
+            self._k = self._free.get()
+            self._fill = 0
+            self._fns = []
+            for i, fe in enumerate(self.files):
+                if hasattr(os, 'posix_fadvise'):
+                    self._prefetch_ahead(i)
+                if self.md5_executor is not None:
+                    self.md5_futures.append((fe, self.md5_executor.submit(
+                        _md5_file, fe[0], self._stop)))
+                if not self._read_file(fe):
+                    return
+            # Add a piece from any remaining data
+            if self._fill:
+                if self._fill % self.piece_size:
+                    self._fns.append(fe[0])
+                self._submit(self._views[self._k][:self._fill])
+        except BaseException as e:
+            self.error = e
+        finally:
+            self._done.put(None)
+
+    def _prefetch_ahead(self, i):
+        # queue reads for the start of the following files while files[i]
+        # is read and hashed
+        if i < self._ahead:
+            self._ahead_bytes -= self.files[i][1]
+        else:
+            self._ahead = i + 1
+            self._ahead_bytes = 0
+        while self._ahead < len(self.files) and \
+                self._ahead_bytes < READAHEAD_SIZE:
+            _prefetch(self.files[self._ahead][0], READAHEAD_SIZE)
+            self._ahead_bytes += self.files[self._ahead][1]
+            self._ahead += 1
+
+    def _read_file(self, fe):
+        # returns False if reading was stopped
+        ps = self.piece_size
+        md5_hasher = md5() if self.md5_inline else None
+        with open(fe[0], 'rb', buffering=0) as f:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            while True:
+                view = self._views[self._k]
+                fill = self._fill
+                n = f.readinto(view[fill:])
+                if not n:
+                    break
+                if md5_hasher is not None:
+                    md5_hasher.update(view[fill:fill + n])
+                self._fns += [fe[0]] * ((fill + n) // ps - fill // ps)
+                self._fill = fill + n
+                if self._fill == len(view):
+                    # only the last batch can end in a partial piece
+                    if self._fill % ps:
+                        self._fns.append(fe[0])
+                    self._submit(view)
+                    self._k = self._free.get()
+                    if self._stop.is_set():
+                        return False
+                    self._fill = 0
+                    self._fns = []
+        if md5_hasher is not None:
+            fe[2]['md5sum'] = md5_hasher.hexdigest()
+        return True
+
+    def _submit(self, view):
+        future = self.executor.submit(_sha1_pieces, view, self.piece_size,
+                                      self._proto)
+        self._done.put((self._fns, future, self._k))
+
+
 class Torrent(object):
 
     def __init__(self, path, trackers=None, web_seeds=None,
                  piece_size=None, private=False, source=None,
                  creation_date=None, comment=None, created_by=None,
-                 include_md5=False, exclude=None):
+                 include_md5=False, exclude=None, parallel_md5=False):
         """
         :param path: path to a file or directory from which to create the torrent
         :param trackers: list/iterable of tracker URLs
@@ -82,6 +332,9 @@ class Torrent(object):
         :param created_by: name/version of the program used to create the .torrent.
             If None, defaults to the value of ``DEFAULT_CREATOR``.
         :param include_md5: If True, also computes and stores MD5 hashes for each file.
+        :param parallel_md5: If True, MD5 hashes are computed in parallel with
+            piece hashing by reading each file a second time. Only worthwhile
+            on fast storage (e.g. SSDs).
         """
 
         self.path = os.path.normpath(path)
@@ -95,8 +348,10 @@ class Torrent(object):
         self.comment = comment
         self.created_by = created_by
         self.include_md5 = include_md5
+        self.parallel_md5 = parallel_md5
 
         self._data = None
+        self._info_digest = None
 
     @property
     def trackers(self):
@@ -104,15 +359,7 @@ class Torrent(object):
 
     @trackers.setter
     def trackers(self, value):
-        tl = []
-        if value:
-            for t in value:
-                pr = urlparse(t)
-                if pr.scheme and pr.netloc:
-                    tl.append(t)
-                else:
-                    raise exceptions.InvalidURLException(t)
-        self._trackers = tl
+        self._trackers = _validate_urls(value)
 
     @property
     def web_seeds(self):
@@ -120,15 +367,7 @@ class Torrent(object):
 
     @web_seeds.setter
     def web_seeds(self, value):
-        tl = []
-        if value:
-            for t in value:
-                pr = urlparse(t)
-                if pr.scheme and pr.netloc:
-                    tl.append(t)
-                else:
-                    raise exceptions.InvalidURLException(t)
-        self._web_seeds = tl
+        self._web_seeds = _validate_urls(value)
 
     @property
     def piece_size(self):
@@ -151,6 +390,44 @@ class Torrent(object):
         else:
             self._piece_size = None
 
+    def _scan_files(self):
+        """
+        Walks the input directory in the same order as ``os.walk`` and
+        yields ``(path, size)`` for every non-empty, non-hidden file that
+        is not excluded.
+        """
+        if self.exclude:
+            exclude_re = re.compile('|'.join(
+                fnmatch.translate(os.path.normcase(p)) for p in self.exclude))
+        else:
+            exclude_re = None
+        stack = [(self.path, '')]
+        while stack:
+            top, rel_top = stack.pop()
+            try:
+                entries = list(os.scandir(top))
+            except OSError:
+                continue
+            subdirs = []
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                rel_path = rel_top + entry.name
+                if is_dir:
+                    if not entry.is_symlink():
+                        subdirs.append((entry.path, rel_path + os.sep))
+                    continue
+                if exclude_re and \
+                        exclude_re.match(os.path.normcase(rel_path)):
+                    continue
+                fsize = entry.stat().st_size
+                fpath = os.path.normpath(entry.path)
+                if fsize and not is_hidden_file(fpath):
+                    yield (fpath, fsize)
+            stack.extend(reversed(subdirs))
+
     def get_info(self):
         """
         Scans the input path and automatically determines the optimal
@@ -168,16 +445,9 @@ class Torrent(object):
         elif os.path.exists(self.path):
             total_size = 0
             total_files = 0
-            for x in os.walk(self.path):
-                for fn in x[2]:
-                    fpath = os.path.normpath(os.path.join(x[0], fn))
-                    rel_path = os.path.relpath(fpath, self.path)
-                    if any(fnmatch.fnmatch(rel_path, ext) for ext in self.exclude):
-                        continue
-                    fsize = os.path.getsize(fpath)
-                    if fsize and not is_hidden_file(fpath):
-                        total_size += fsize
-                        total_files += 1
+            for fpath, fsize in self._scan_files():
+                total_size += fsize
+                total_files += 1
         else:
             raise exceptions.InvalidInputException
         if not (total_files and total_size):
@@ -185,14 +455,10 @@ class Torrent(object):
         if self.piece_size:
             ps = self.piece_size
         else:
-            ps = 1 << max(0, math.ceil(math.log(total_size / 1500, 2)))
-            if ps < MIN_PIECE_SIZE:
-                ps = MIN_PIECE_SIZE
-            if ps > MAX_PIECE_SIZE:
-                ps = MAX_PIECE_SIZE
-        return (total_size, total_files, ps, math.ceil(total_size / ps))
-
-    def generate(self, callback=None):
+            ps = _auto_piece_size(total_size)
+        return (total_size, total_files, ps, -(-total_size // ps))
+
+    def generate(self, callback=None, threads=None):
         """
         Computes and stores piece data. Returns ``True`` on success, ``False``
         otherwise.
@@ -203,21 +469,16 @@ class Torrent(object):
             GUI/threaded context, and if torrent generation needs to be cancelled.
             The callable's return value should evaluate to ``True`` to trigger
             cancellation.
+        :param threads: number of threads used to hash pieces. If None,
+            defaults to the number of CPUs.
         """
         files = []
         single_file = os.path.isfile(self.path)
         if single_file:
             files.append((self.path, os.path.getsize(self.path), {}))
         elif os.path.exists(self.path):
-            for x in os.walk(self.path):
-                for fn in x[2]:
-                    fpath = os.path.normpath(os.path.join(x[0], fn))
-                    rel_path = os.path.relpath(fpath, self.path)
-                    if any(fnmatch.fnmatch(rel_path, ext) for ext in self.exclude):
-                        continue
-                    fsize = os.path.getsize(fpath)
-                    if fsize and not is_hidden_file(fpath):
-                        files.append((fpath, fsize, {}))
+            for fpath, fsize in self._scan_files():
+                files.append((fpath, fsize, {}))
         else:
             raise exceptions.InvalidInputException
         total_size = sum([x[1] for x in files])
@@ -227,47 +488,48 @@ class Torrent(object):
         if self.piece_size is None:
             self.piece_size = self.get_info()[2]
         if files:
-            self._pieces = bytearray()
-            i = 0
-            num_pieces = math.ceil(total_size / self.piece_size)
+            num_pieces = -(-total_size // self.piece_size)
             pc = 0
-            buf = bytearray()
-            while i < len(files):
-                fe = files[i]
-                f = open(fe[0], 'rb')
-                if self.include_md5:
-                    md5_hasher = md5()
-                else:
-                    md5_hasher = None
-                for chunk in iter(lambda: f.read(self.piece_size), b''):
-                    buf += chunk
-                    if len(buf) >= self.piece_size \
-                            or i == len(files)-1:
-                        piece = buf[:self.piece_size]
-                        self._pieces += sha1(piece).digest()
-                        del buf[:self.piece_size]
-                        pc += 1
+            # Small pieces are batched so that each hashing job covers at
+            # least HASH_BATCH_SIZE bytes, keeping per-job overhead low.
+            # A buffer never holds more than the whole input, and there are
+            # never more buffers than batches.
+            ps = self.piece_size
+            bs = min(ps * max(1, HASH_BATCH_SIZE // ps), total_size)
+            # digests of each hashing job, joined into the pieces string at
+            # the end, which sizes and copies it exactly once
+            pieces = []
+            workers = threads or os.cpu_count() or 1
+            num_buffers = min(
+                max(2, min(2 * workers, PIECE_BUFFER_MEMORY // bs)),
+                -(-total_size // bs))
+            md5_parallel = self.include_md5 and self.parallel_md5
+            # MD5 jobs get their own threads so that they never hold up
+            # piece hashing
+            with ThreadPoolExecutor(max_workers=workers) as executor, \
+                    ThreadPoolExecutor(max_workers=workers) as md5_executor:
+                reader = _PieceReader(
+                    files, ps, bs, num_buffers, executor,
+                    md5_inline=self.include_md5 and not md5_parallel,
+                    md5_executor=md5_executor if md5_parallel else None)
+                reader.start()
+                try:
+                    for fns, digests in reader.results():
+                        pieces.append(digests)
                         if callback:
-                            cancel = callback(fe[0], pc, num_pieces)
-                            if cancel:
-                                f.close()
-                                return False
-                    if self.include_md5:
-                        md5_hasher.update(chunk)
-                if self.include_md5:
-                    fe[2]['md5sum'] = md5_hasher.hexdigest()
-                f.close()
-                i += 1
-            # Add pieces from any remaining data
-            while len(buf):
-                piece = buf[:self.piece_size]
-                self._pieces += sha1(piece).digest()
-                del buf[:self.piece_size]
-                pc += 1
-                if callback:
-                    cancel = callback(fe[0], pc, num_pieces)
-                    if cancel:
-                        return False
+                            for fn in fns:
+                                pc += 1
+                                cancel = callback(fn, pc, num_pieces)
+                                if cancel:
+                                    return False
+                finally:
+                    reader.close()
+                if reader.error is None:
+                    for fe, future in reader.md5_futures:
+                        fe[2]['md5sum'] = future.result()
+            if reader.error is not None:
+                raise reader.error
+            self._pieces = b''.join(pieces)
 
         # Create the torrent data structure
         data = OrderedDict()
@@ -280,7 +542,7 @@ class Torrent(object):
         if self.created_by:
             data['created by'] = self.created_by.encode()
         else:
-            data['created by'] = DEFAULT_CREATOR.encode()
+            data['created by'] = _DEFAULT_CREATOR_B
         if self.creation_date:
             data['creation date'] = int(self.creation_date.timestamp())
         if self.web_seeds:
@@ -294,22 +556,23 @@ class Torrent(object):
         else:
             data['info']['files'] = []
             path_sp = self.path.split(os.sep)
+            path_depth = len(path_sp)
             for x in files:
                 fx = OrderedDict()
                 fx['length'] = x[1]
                 if self.include_md5:
                     fx['md5sum'] = x[2]['md5sum']
-                fx['path'] = [y.encode()
-                              for y in x[0].split(os.sep)[len(path_sp):]]
+                fx['path'] = x[0].encode().split(_SEP_B)[path_depth:]
                 data['info']['files'].append(fx)
             data['info']['name'] = path_sp[-1].encode()
-        data['info']['pieces'] = bytes(self._pieces)
+        data['info']['pieces'] = self._pieces
         data['info']['piece length'] = self.piece_size
         data['info']['private'] = int(self.private)
         if self.source:
             data['info']['source'] = self.source.encode()
 
         self._data = data
+        self._info_digest = None
         return True
 
     @property
@@ -325,6 +588,14 @@ class Torrent(object):
         else:
             raise exceptions.TorrentNotGeneratedException
 
+    def _get_info_digest(self):
+        # The info dict can be modified through data, so it is bencoded on
+        # every call; hashing is skipped while the encoding is unchanged.
+        info = bencode(self._data['info'])
+        if self._info_digest is None or self._info_digest[0] != info:
+            self._info_digest = (info, sha1(info).digest())
+        return self._info_digest[1]
+
     @property
     def info_hash_base32(self):
         """
@@ -334,7 +605,7 @@ class Torrent(object):
         .. note:: ``generate()`` must be called first.
         """
         if getattr(self, '_data', None):
-            return b32encode(sha1(bencode(self._data['info'])).digest())
+            return b32encode(self._get_info_digest())
         else:
             raise exceptions.TorrentNotGeneratedException
 
@@ -347,7 +618,7 @@ class Torrent(object):
         .. note:: ``generate()`` must be called first.
         """
         if getattr(self, '_data', None):
-            return sha1(bencode(self._data['info'])).hexdigest()
+            return self._get_info_digest().hex()
         else:
             raise exceptions.TorrentNotGeneratedException
 